@@ -8,7 +8,23 @@
 #
 # USAGE:
 #
-# python3 ./dev-tools/prepare_release_update_documentation.py
+# python3 ./dev-tools/prepare_release_update_documentation.py [--workers 4]
+#
+# Additional versions and free-form rules can be applied in the same pass:
+#
+# python3 ./dev-tools/prepare_release_update_documentation.py --version 7.16.1 --rule 'deprecated[7.x' 'removed[7.x'
+#
+# The versions referenced by 'coming[...]' tags are kept in an index under
+# .git/ (see --index) so later runs only open the files that mention them.
+#
+# To preview the changes and get a per-phase timing report without writing,
+# staging or committing anything:
+#
+# python3 ./dev-tools/prepare_release_update_documentation.py --dry-run
+#
+# The version lookup, the checkout check and the docs walk run concurrently;
+# --trace writes the timings of these steps, and of the git commands and
+# docs walk and rewrite phases they run, as a Chrome trace.
 #
 # Note: Ensure the script is run from the root directory
 #       This script needs to be run and then pushed,
@@ -16,60 +32,132 @@
 #       on your build VM
 #
 
+import argparse
+import collections
+import contextlib
+import difflib
 import fnmatch
+import hashlib
+import json
 import subprocess
 import tempfile
 import re
 import os
 import shutil
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from release_tasks import TaskRunner, span, write_trace
+
+# (phase, start time, wall-clock seconds spent) per completed phase;
+# phases may overlap
+TIMINGS = []
+# Counters for files scanned and bytes read/written
+STATS = collections.Counter()
+
+# Records the wall-clock time spent in the enclosed block
+# under the given phase name, also as a span of the trace.
+@contextlib.contextmanager
+def timed(phase):
+  started_at = time.time()
+  try:
+    with span(phase, 'phase'):
+      yield
+  finally:
+    TIMINGS.append((phase, started_at, time.time() - started_at))
+
+# Prints the recorded phase timings and counters.
+def print_report():
+  print('*** Timing report:')
+  for phase, _, took in sorted(TIMINGS, key=lambda timing: timing[1]):
+    print('  %-16s %8.3f seconds' % (phase, took))
+  total = max(start + took for _, start, took in TIMINGS) - min(start for _, start, _ in TIMINGS) if TIMINGS else 0
+  print('  %-16s %8.3f seconds' % ('total', total))
+  for counter in ('files_indexed', 'files_scanned', 'files_modified', 'bytes_read', 'bytes_written'):
+    print('  %-16s %8d' % (counter, STATS[counter]))
 
 def run(command):
-  if os.system('%s' % (command)):
-    raise RuntimeError('    FAILED: %s' % (command))
+  with span(command, 'subprocess'):
+    if os.system('%s' % (command)):
+      raise RuntimeError('    FAILED: %s' % (command))
+
+# Parses the output of 'git status --porcelain=v2 --branch'
+# into the number of commits ahead of and behind upstream,
+# the changed (tracked) and the untracked paths.
+def parse_git_status(status):
+  ahead, behind = 0, 0
+  changed, untracked = [], []
+  for line in status.splitlines():
+    if line.startswith('# branch.ab '):
+      ahead_token, behind_token = line.split()[2:4]
+      ahead, behind = int(ahead_token), -int(behind_token)
+    elif line.startswith('? '):
+      untracked.append(line[2:])
+    elif line[:2] in ('1 ', '2 ', 'u '):
+      changed.append(line)
+  return ahead, behind, changed, untracked
 
 def ensure_checkout_is_clean():
+  # A single status call covers local mods, untracked files and the upstream state
+  with span('git status --porcelain=v2 --branch', 'subprocess'):
+    s = subprocess.check_output(['git', 'status', '--porcelain=v2', '--branch']).decode('utf-8', errors='replace')
+  ahead, behind, changed, untracked = parse_git_status(s)
+
   # Make sure no local mods:
-  s = subprocess.check_output('git diff --shortstat', shell=True)
-  if len(s) > 0:
-    raise RuntimeError('git diff --shortstat is non-empty: got:\n%s' % s)
+  if changed:
+    raise RuntimeError('git status shows local modifications: got:\n%s' % s)
 
   # Make sure no untracked files:
-  s = subprocess.check_output('git status', shell=True).decode('utf-8', errors='replace')
-  if 'Untracked files:' in s:
+  if untracked:
     raise RuntimeError('git status shows untracked files: got:\n%s' % s)
 
   # Make sure we have all changes from origin:
-  if 'is behind' in s:
+  if behind:
     raise RuntimeError('git status shows not all changes pulled from origin; try running "git pull origin" in this branch: got:\n%s' % (s))
 
   # Make sure we no local unpushed changes (this is supposed to be a clean area):
-  if 'is ahead' in s:
+  if ahead:
     raise RuntimeError('git status shows local commits; try running "git fetch origin", "git checkout ", "git reset --hard origin/" in this branch: got:\n%s' % (s))
 
 # Reads the given file and applies the
 # callback to it. If the callback changed
 # a line the given file is replaced with
-# the modified input.
-def process_file(file_path, line_callback):
-  fh, abs_path = tempfile.mkstemp()
-  modified = False
-  with open(abs_path,'w', encoding='utf-8') as new_file:
-    with open(file_path, encoding='utf-8') as old_file:
-      for line in old_file:
-        new_line = line_callback(line)
-        modified = modified or (new_line != line)
-        new_file.write(new_line)
-  os.close(fh)
-  if modified:
-    #Remove original file
-    os.remove(file_path)
-    #Move new file
-    shutil.move(abs_path, file_path)
+# the modified input. If a marker (a compiled
+# bytes regex) is given, files it doesn't match
+# are skipped without running the callback.
+# In dry-run mode the file is left untouched and
+# the unified diff of the change is passed to the
+# given on_diff callback instead. Files scanned and
+# bytes read/written are counted into stats.
+def process_file(file_path, line_callback, marker=None, dry_run=False, on_diff=None, stats=STATS):
+  with open(file_path, 'rb') as old_file:
+    data = old_file.read()
+  stats['files_scanned'] += 1
+  stats['bytes_read'] += len(data)
+  if marker is not None and not marker.search(data):
+    return False
+  old_lines = data.decode('utf-8').splitlines(keepends=True)
+  new_lines = [line_callback(line) for line in old_lines]
+  if new_lines == old_lines:
+    return False
+  stats['files_modified'] += 1
+  if dry_run:
+    if on_diff:
+      on_diff(''.join(difflib.unified_diff(old_lines, new_lines, 'a/' + file_path, 'b/' + file_path)))
     return True
-  else:
-    # nothing to do - just remove the tmp file
+  new_content = ''.join(new_lines).encode('utf-8')
+  # write next to the original so the replace is atomic
+  fh, abs_path = tempfile.mkstemp(dir=os.path.dirname(file_path) or '.')
+  try:
+    with os.fdopen(fh, 'wb') as new_file:
+      new_file.write(new_content)
+    stats['bytes_written'] += len(new_content)
+    shutil.copymode(file_path, abs_path)
+    os.replace(abs_path, file_path)
+  except BaseException:
     os.remove(abs_path)
-    return False
+    raise
+  return True
 
 # Checks the pom.xml for the release version.
 # This method fails if the pom file has no SNAPSHOT version set ie.
@@ -83,47 +171,249 @@ def find_release_version():
         return match.group(1)
     raise RuntimeError('Could not find release version in branch')
 
-# Stages the given files for the next git commit
+# Stages the given files for the next git commit. All
+# files are passed to a single 'git add' through stdin.
 def add_pending_files(*files):
-  for file in files:
-    if file:
-      # print("Adding file: %s" % (file))
-      run('git add %s' % (file))
+  pathspecs = [file for file in files if file]
+  if not pathspecs:
+    return
+  command = ['git', 'add', '--pathspec-from-file=-', '--pathspec-file-nul']
+  print('*** Running: %s (%d files)' % (' '.join(command), len(pathspecs)))
+  with span(' '.join(command), 'subprocess', files=len(pathspecs)):
+    if subprocess.run(command, input='\0'.join(pathspecs).encode('utf-8')).returncode:
+      raise RuntimeError('    FAILED: %s' % ' '.join(command))
 
 # Updates documentation feature flags
 def commit_feature_flags(release):
     run('git commit -m "Update Documentation Feature Flags [%s]"' % release)
 
-# Walks the given directory path (defaults to 'docs')
-# and replaces all 'coming[$version]' tags with
-# 'added[$version]'. This method only accesses asciidoc files.
-def update_reference_docs(release_version, path='docs'):
-  pattern = 'coming[%s' % (release_version)
-  replacement = 'added[%s' % (release_version)
-  pending_files = []
+# Returns the rules turning 'coming[$version' tags
+# into 'added[$version' for each of the given versions.
+def release_rules(release_versions):
+  return [('coming[%s' % version, 'added[%s' % version) for version in release_versions]
+
+# Compiles the given (pattern, replacement) rules into
+# a single regex so that all of them are applied in one
+# pass over a line. Longer patterns are tried first so a
+# pattern that is a prefix of another doesn't shadow it.
+# Returns the line callback and a bytes regex that finds
+# any of the patterns in a file's raw content.
+def compile_rules(rules):
+  replacements = dict(rules)
+  patterns = sorted(replacements, key=len, reverse=True)
+  regex = re.compile('|'.join(re.escape(pattern) for pattern in patterns))
+  marker = re.compile(b'|'.join(re.escape(pattern.encode('utf-8')) for pattern in patterns))
   def callback(line):
-    return line.replace(pattern, replacement)
+    return regex.sub(lambda match: replacements[match.group(0)], line)
+  return callback, marker
+
+# Rewrites a shard of files applying the given rules.
+# Returns the modified files (in shard order), the
+# seconds the shard took, its counters and, in dry-run
+# mode, the diffs of the planned changes. Diffs are
+# printed right away instead if stream_diffs is set.
+def process_shard(file_paths, rules, dry_run=False, stream_diffs=False):
+  started_at = time.time()
+  callback, marker = compile_rules(rules)
+  stats = collections.Counter()
+  diffs = []
+  on_diff = sys.stdout.write if stream_diffs else diffs.append
+  modified = [file_path for file_path in file_paths
+              if process_file(file_path, callback, marker=marker, dry_run=dry_run, on_diff=on_diff, stats=stats)]
+  return modified, time.time() - started_at, stats, diffs
+
+# Splits the given list into at most num_shards
+# contiguous chunks of (nearly) equal size.
+def split_shards(items, num_shards):
+  num_shards = max(1, min(num_shards, len(items)))
+  size, rest = divmod(len(items), num_shards)
+  shards = []
+  start = 0
+  for i in range(num_shards):
+    end = start + size + (1 if i < rest else 0)
+    shards.append(items[start:end])
+    start = end
+  return shards
+
+# Returns all asciidoc files below the given path.
+def find_asciidoc_files(path):
+  asciidoc_files = []
   for root, _, file_names in os.walk(path):
     for file_name in fnmatch.filter(file_names, '*.asciidoc'):
-      full_path = os.path.join(root, file_name)
-      if process_file(full_path, callback):
-        pending_files.append(os.path.join(root, file_name))
-  return pending_files
+      asciidoc_files.append(os.path.join(root, file_name))
+  return asciidoc_files
+
+# Format version of the persisted marker index; bump it
+# whenever the layout of the entries changes.
+MARKER_INDEX_FORMAT = 1
+# Captures the version part of 'coming[$version]' or
+# 'coming[$version, $text]' tags.
+COMING_MARKER = re.compile(rb'coming\[([^\],]+)')
+
+# Loads the marker index from the given path. Returns an
+# empty index if the file is missing, unreadable or of
+# another format.
+def load_marker_index(index_path):
+  try:
+    with open(index_path, encoding='utf-8') as index_file:
+      index = json.load(index_file)
+    if index.get('format') == MARKER_INDEX_FORMAT:
+      return index['files']
+  except (OSError, ValueError, KeyError, AttributeError):
+    pass
+  return {}
+
+# Atomically writes the marker index to the given path.
+def store_marker_index(index_path, entries):
+  fh, abs_path = tempfile.mkstemp(dir=os.path.dirname(index_path) or '.')
+  try:
+    with os.fdopen(fh, 'w', encoding='utf-8') as index_file:
+      json.dump({'format': MARKER_INDEX_FORMAT, 'files': entries}, index_file)
+    os.replace(abs_path, index_path)
+  except BaseException:
+    os.remove(abs_path)
+    raise
+
+# Brings the marker index at the given path up to date for
+# the given files and returns its entries. Each entry maps
+# a file to [mtime_ns, size, sha1, versions]; a file is only
+# read if its mtime or size changed and only re-scanned for
+# markers if its content hash changed too.
+def refresh_marker_index(index_path, file_paths):
+  old_entries = load_marker_index(index_path)
+  entries = {}
+  for file_path in file_paths:
+    stat = os.stat(file_path)
+    entry = old_entries.get(file_path)
+    if entry is None or entry[0] != stat.st_mtime_ns or entry[1] != stat.st_size:
+      with open(file_path, 'rb') as file:
+        data = file.read()
+      STATS['files_indexed'] += 1
+      STATS['bytes_read'] += len(data)
+      digest = hashlib.sha1(data).hexdigest()
+      if entry is None or entry[2] != digest:
+        versions = sorted(set(version.decode('utf-8', errors='replace') for version in COMING_MARKER.findall(data)))
+      else:
+        versions = entry[3]
+      entry = [stat.st_mtime_ns, stat.st_size, digest, versions]
+    entries[file_path] = entry
+  if entries != old_entries:
+    store_marker_index(index_path, entries)
+  return entries
+
+# Walks the given directory path (defaults to 'docs')
+# and replaces all 'coming[$version]' tags with
+# 'added[$version]' for the given version (or list of
+# versions) as well as any extra (pattern, replacement)
+# rules, all in a single pass over each file.
+# This method only accesses asciidoc files.
+# With more than one worker the files are split into shards
+# that are rewritten by a process pool; the modified files
+# are returned in the same order as in the serial case.
+# If an index path is given only files whose indexed markers
+# mention one of the versions are opened; extra rules can't
+# be served from the index and always scan all files.
+# In dry-run mode nothing is written; the unified diff of
+# every planned change is printed and the files that would
+# be modified are returned.
+def update_reference_docs(release_version, path='docs', workers=1, extra_rules=(), index_path=None, dry_run=False):
+  asciidoc_files, entries = walk_reference_docs(path, index_path if not extra_rules else None)
+  return rewrite_reference_docs(release_version, asciidoc_files, entries, workers, extra_rules, dry_run)
+
+# Finds the asciidoc files under the given path and, if an
+# index path is given, refreshes their indexed markers.
+# Returns the files and the index entries (or None).
+def walk_reference_docs(path='docs', index_path=None):
+  with timed('walk'):
+    asciidoc_files = find_asciidoc_files(path)
+    entries = refresh_marker_index(index_path, asciidoc_files) if index_path else None
+  return asciidoc_files, entries
+
+# Rewrites the given asciidoc files, see update_reference_docs.
+# Given index entries, only the files they list as mentioning
+# one of the versions are opened.
+def rewrite_reference_docs(release_version, asciidoc_files, entries=None, workers=1, extra_rules=(), dry_run=False):
+  release_versions = [release_version] if isinstance(release_version, str) else list(release_version)
+  rules = release_rules(release_versions) + list(extra_rules)
+  if entries is not None and not extra_rules:
+    asciidoc_files = [file_path for file_path in asciidoc_files
+                      if any(marker.startswith(version) for marker in entries[file_path][3] for version in release_versions)]
+  with timed('rewrite'):
+    if workers <= 1 or len(asciidoc_files) <= 1:
+      pending_files, _, stats, _ = process_shard(asciidoc_files, rules, dry_run=dry_run, stream_diffs=True)
+      STATS.update(stats)
+      return pending_files
+    shards = split_shards(asciidoc_files, workers)
+    pending_files = []
+    with ProcessPoolExecutor(max_workers=len(shards)) as executor:
+      results = executor.map(process_shard, shards, [rules] * len(shards), [dry_run] * len(shards))
+      for i, (modified, took, stats, diffs) in enumerate(results):
+        for diff in diffs:
+          sys.stdout.write(diff)
+        print('  shard %d/%d: %d files, %d modified, took %.2f seconds' % (i + 1, len(shards), len(shards[i]), len(modified), took))
+        STATS.update(stats)
+        pending_files.extend(modified)
+    return pending_files
 
 if __name__ == "__main__":
-  release_version = find_release_version()
+  parser = argparse.ArgumentParser(description='Updates the documentation feature flags for a release and commits them')
+  parser.add_argument('--workers', '-w', dest='workers', type=int, default=1,
+                      help='Number of processes used to rewrite the docs (default: 1, serial)')
+  parser.add_argument('--version', '-v', dest='versions', action='append', default=[],
+                      help='Additional version to turn from coming[] into added[]; can be repeated')
+  parser.add_argument('--rule', dest='rules', nargs=2, action='append', default=[], metavar=('PATTERN', 'REPLACEMENT'),
+                      help='Additional literal replacement applied in the same pass; can be repeated')
+  parser.add_argument('--index', dest='index', default=os.path.join('.git', 'docs-marker-index.json') if os.path.isdir('.git') else '',
+                      help='Path of the persisted docs marker index; pass an empty value to disable it')
+  parser.add_argument('--dry-run', '-n', dest='dry_run', action='store_true', default=False,
+                      help='Print the diff of the planned changes and a timing report without writing or committing')
+  parser.add_argument('--trace', dest='trace', default=None,
+                      help='File to write the timings of the steps to, as a Chrome trace')
+  args = parser.parse_args()
+  extra_rules = [tuple(rule) for rule in args.rules]
 
-  print('*** Preparing release version documentation: [%s]' % release_version)
+  def find_versions():
+    with timed('find version'):
+      release_versions = [find_release_version()] + [v for v in args.versions if v]
+    print('*** Preparing release version documentation: [%s]' % ', '.join(release_versions))
+    return release_versions
 
-  ensure_checkout_is_clean()
+  def check_clean():
+    with timed('clean check'):
+      try:
+        ensure_checkout_is_clean()
+      except RuntimeError as e:
+        if not args.dry_run:
+          raise
+        print('WARNING: %s' % e)
 
-  pending_files = update_reference_docs(release_version)
+  def rewrite(release_versions, walked):
+    return rewrite_reference_docs(release_versions, walked[0], walked[1], workers=args.workers, extra_rules=extra_rules,
+                                  dry_run=args.dry_run)
 
-  if pending_files:
-    add_pending_files(*pending_files) # expects var args use * to expand
-    commit_feature_flags(release_version)
-  else:
-    print('WARNING: no documentation references updates for release %s' % (release_version))
+  def stage(release_versions, pending_files):
+    release_version = ', '.join(release_versions)
+    if args.dry_run:
+      print('*** Dry run: %d files would be updated for release %s' % (len(pending_files), release_version))
+    elif pending_files:
+      with timed('staging'):
+        add_pending_files(*pending_files) # expects var args use * to expand
+        commit_feature_flags(release_version)
+    else:
+      print('WARNING: no documentation references updates for release %s' % (release_version))
 
-  print('*** Done.')
+  # walk -> rewrite -> stage, the docs are only rewritten once the checkout is known to be clean
+  runner = TaskRunner(workers=3)
+  versions = runner.add('find version', find_versions)
+  clean = runner.add('clean check', check_clean)
+  walk = runner.add('walk', walk_reference_docs, 'docs', args.index if not extra_rules else None)
+  pending = runner.add('rewrite', rewrite, versions, walk, deps=[clean])
+  runner.add('stage', stage, versions, pending)
+  try:
+    runner.run()
+  finally:
+    if args.trace:
+      write_trace(args.trace)
 
+  print_report()
+  print('*** Done.')
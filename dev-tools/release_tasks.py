@@ -0,0 +1,272 @@
+# Copyright Elasticsearch B.V. and/or licensed to Elasticsearch B.V. under one
+# or more contributor license agreements. Licensed under the Elastic License
+# 2.0 and the Server Side Public License, v 1; you may not use this file except
+# in compliance with, at your election, the Elastic License 2.0 or the Server
+# Side Public License, v 1.
+
+# Runs the steps of the release tooling as a graph of tasks
+#
+# Shared by dev-tools/prepare_release_update_documentation.py,
+# x-pack/dev-tools/smoke_test_xpack_rc.py and the TDVT runner of
+# the Tableau connector. A task runs as soon as the tasks it depends
+# on completed, concurrently with the other ready tasks; the tasks
+# of a group can be limited to a number of concurrent runs. A task's
+# arguments may refer to the results of earlier tasks:
+#
+#   runner = TaskRunner(workers=4)
+#   download = runner.add('download', fetch, url)
+#   runner.add('unzip', extract_zip, download, dest_dir)
+#   runner.run()
+#
+# Tasks given a cache key are skipped, and their previous result is
+# returned instead, if the key and those of all the tasks they depend
+# on are unchanged since their last successful run, none of these
+# tasks ran again since, and their outputs still exist. The cache is
+# kept in the given JSON file, along with any other state the caller
+# stores in `runner.state`.
+#
+# The start and duration of each task can be printed. Each task is
+# also recorded as a span, along with the spans the scripts record
+# with span() for their subprocesses, HTTP requests and file system
+# phases; write_trace() exports them all as a Chrome trace (open it
+# with chrome://tracing or ui.perfetto.dev):
+#
+#   with span('git status', 'subprocess'):
+#     ...
+#   write_trace('trace.json')
+
+import collections
+import contextlib
+import hashlib
+import itertools
+import json
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+Ref = collections.namedtuple('Ref', ['name'])
+
+Task = collections.namedtuple('Task', ['name', 'func', 'args', 'deps', 'group', 'cache_key', 'outputs'])
+
+# (name, started at, seconds taken, whether the result was cached, whether it failed, thread name) per run task
+Timing = collections.namedtuple('Timing', ['name', 'started_at', 'took', 'cached', 'failed', 'thread'])
+
+Span = collections.namedtuple('Span', ['id', 'parent', 'name', 'category', 'started_at', 'took', 'thread', 'args'])
+
+# the completed spans, across all threads
+SPANS = []
+span_ids = itertools.count(1)
+# per thread, the ids of the spans it's in, innermost last
+span_stacks = threading.local()
+
+def span_stack():
+  if not hasattr(span_stacks, 'ids'):
+    span_stacks.ids = []
+  return span_stacks.ids
+
+# Records the enclosed block as a span of the given category, nested in
+# the span the thread is in. The keyword args, and any entries the block
+# adds to the yielded dict, are exported with the span; so is the error
+# the block raises, if any.
+@contextlib.contextmanager
+def span(name, category='step', **args):
+  stack = span_stack()
+  parent = stack[-1] if stack else None
+  span_id = next(span_ids)
+  stack.append(span_id)
+  started_at = time.time()
+  try:
+    yield args
+  except BaseException as e:
+    args['error'] = str(e).strip() or type(e).__name__
+    raise
+  finally:
+    stack.pop()
+    SPANS.append(Span(span_id, parent, name, category, started_at, time.time() - started_at,
+                      threading.current_thread().name, args))
+
+# Wraps func so that the spans it records are nested in the span the
+# caller is in, for functions run by another thread (e.g. a pool's).
+def in_span(func):
+  stack = span_stack()
+  parent = stack[-1] if stack else None
+  def run_in_span(*args, **kwargs):
+    stack = span_stack()
+    stack.append(parent)
+    try:
+      return func(*args, **kwargs)
+    finally:
+      stack.pop()
+  return run_in_span
+
+# Writes all spans recorded so far as a Chrome trace, one row per thread.
+# Each span's args name its parent span, which is how spans started from
+# another thread are tied to their step.
+def write_trace(path):
+  spans = list(SPANS)
+  origin = min((s.started_at for s in spans), default=time.time())
+  names = {s.id: s.name for s in spans}
+  threads = sorted(set(s.thread for s in spans))
+  events = [{'name': 'thread_name', 'ph': 'M', 'pid': os.getpid(), 'tid': tid, 'args': {'name': thread}}
+            for tid, thread in enumerate(threads)]
+  for s in sorted(spans, key=lambda s: s.started_at):
+    args = dict(s.args, parent=names.get(s.parent)) if s.parent else s.args
+    events.append({'name': s.name, 'cat': s.category, 'ph': 'X', 'pid': os.getpid(), 'tid': threads.index(s.thread),
+                   'ts': round((s.started_at - origin) * 1e6), 'dur': round(s.took * 1e6), 'args': args})
+  with open(path, 'w', encoding='utf-8') as f:
+    json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f, default=str)
+
+def load_state(path):
+  try:
+    with open(path, encoding='utf-8') as f:
+      return json.load(f)
+  except (OSError, ValueError):
+    return {}
+
+def store_state(path, state):
+  with open(path + '.tmp', 'w', encoding='utf-8') as f:
+    json.dump(state, f, indent=2)
+  os.replace(path + '.tmp', path)
+
+class TaskRunner:
+
+  def __init__(self, workers=4, limits=None, cache_path=None, force=False):
+    self.workers = max(1, workers)
+    self.limits = dict(limits or {})
+    self.cache_path = cache_path
+    self.force = force
+    self.state = load_state(cache_path) if cache_path else {}
+    self.tasks = collections.OrderedDict()
+    self.results = {}
+    self.errors = collections.OrderedDict()
+    self.skipped = []
+    self.timings = []
+    self.fingerprints = {}
+    self.lock = threading.Lock()
+
+  # Adds a task running func(*args) once the `deps` tasks and those
+  # referred to by its arguments completed. Returns a reference to the
+  # task, to be passed as an argument or dependency of later tasks.
+  def add(self, name, func, *args, deps=(), group=None, cache_key=None, outputs=()):
+    if name in self.tasks:
+      raise ValueError('duplicate task [%s]' % name)
+    dep_names = []
+    for dep in list(deps) + [arg for arg in args if isinstance(arg, Ref)]:
+      dep_name = dep.name if isinstance(dep, Ref) else dep
+      if dep_name not in self.tasks:
+        raise ValueError('task [%s] depends on unknown task [%s]' % (name, dep_name))
+      if dep_name not in dep_names:
+        dep_names.append(dep_name)
+    if group is not None and group not in self.limits:
+      raise ValueError('task [%s] is in unknown group [%s]' % (name, group))
+    self.tasks[name] = Task(name, func, args, dep_names, group, cache_key, tuple(outputs))
+    return Ref(name)
+
+  # Runs all tasks and returns their {name: result}. Tasks depending on
+  # a failed task are skipped. With fail_fast no more tasks are started
+  # after a failure and the first error is raised once the running tasks
+  # completed; otherwise the failures are left in `errors`. If the run is
+  # interrupted (e.g. by Ctrl+C) the error is raised right away, without
+  # waiting for the running tasks, so the caller can stop them.
+  def run(self, fail_fast=True):
+    pending = collections.OrderedDict(self.tasks)
+    running = {}
+    group_counts = collections.Counter()
+    stopped = False
+    executor = ThreadPoolExecutor(max_workers=self.workers)
+    try:
+      while pending or running:
+        for name, task in list(pending.items()):
+          if stopped or any(dep in self.errors or dep in self.skipped for dep in task.deps):
+            del pending[name]
+            self.skipped.append(name)
+          elif all(dep in self.results for dep in task.deps) and \
+              (task.group is None or group_counts[task.group] < self.limits[task.group]):
+            del pending[name]
+            group_counts[task.group] += 1
+            running[executor.submit(in_span(self.run_task), task)] = task
+        if not running:
+          continue
+        done, _ = wait(running, return_when=FIRST_COMPLETED)
+        for future in done:
+          task = running.pop(future)
+          group_counts[task.group] -= 1
+          try:
+            self.results[task.name] = future.result()
+          except Exception as e:
+            self.errors[task.name] = e
+            stopped = stopped or fail_fast
+    except BaseException:
+      for future in running:
+        future.cancel()
+      executor.shutdown(wait=False)
+      raise
+    executor.shutdown()
+    if fail_fast and self.errors:
+      raise next(iter(self.errors.values()))
+    return self.results
+
+  # A task's fingerprint covers its cache key and the fingerprints of the
+  # tasks it depends on, as of their last run: each run of a task gets a
+  # new id, which invalidates its dependents. Tasks without a cache key,
+  # or depending on such a task, aren't cached.
+  def fingerprint(self, task):
+    dep_fingerprints = [self.fingerprints.get(dep) for dep in task.deps]
+    if task.cache_key is None or None in dep_fingerprints:
+      return None
+    return hashlib.sha1(json.dumps([task.name, task.cache_key, dep_fingerprints], sort_keys=True).encode('utf-8')).hexdigest()
+
+  def update_cache(self, name, entry):
+    with self.lock:
+      cache = self.state.setdefault('tasks', {})
+      if entry is None:
+        cache.pop(name, None)
+      else:
+        cache[name] = entry
+      store_state(self.cache_path, self.state)
+
+  def run_task(self, task):
+    started_at = time.time()
+    with span(task.name, 'task', group=task.group) as args:
+      try:
+        result, args['cached'] = self.run_cached(task)
+      except Exception:
+        self.timings.append(Timing(task.name, started_at, time.time() - started_at, False, True, threading.current_thread().name))
+        raise
+    self.timings.append(Timing(task.name, started_at, time.time() - started_at, args['cached'], False, threading.current_thread().name))
+    return result
+
+  # Returns the task's result, and whether it was taken from the cache.
+  def run_cached(self, task):
+    fingerprint = self.fingerprint(task) if self.cache_path else None
+    self.fingerprints[task.name] = None
+    if fingerprint is not None:
+      with self.lock:
+        entry = self.state.get('tasks', {}).get(task.name)
+      if not self.force and entry and entry['fingerprint'] == fingerprint and 'run' in entry and \
+          all(os.path.exists(o) for o in task.outputs):
+        print('Skipping %s, inputs unchanged.' % task.name)
+        self.fingerprints[task.name] = entry['run']
+        return entry['result'], True
+      self.update_cache(task.name, None) # don't trust a task that didn't complete
+    args = [self.results[arg.name] if isinstance(arg, Ref) else arg for arg in task.args]
+    result = task.func(*args)
+    if fingerprint is not None:
+      try:
+        json.dumps(result)
+      except TypeError:
+        return result, False # can't be restored from the cache, neither can its dependents
+      run = hashlib.sha1((fingerprint + uuid.uuid4().hex).encode('utf-8')).hexdigest()
+      self.update_cache(task.name, {'fingerprint': fingerprint, 'run': run, 'result': result})
+      self.fingerprints[task.name] = run
+    return result, False
+
+  def print_timings(self):
+    print('*** Task timings:')
+    for timing in sorted(self.timings, key=lambda t: t.started_at):
+      print('  %-40s %8.3f seconds%s' % (timing.name, timing.took, ' (cached)' if timing.cached else ' (failed)' if timing.failed else ''))
+    if self.timings:
+      wall_clock = max(t.started_at + t.took for t in self.timings) - min(t.started_at for t in self.timings)
+      print('  %-40s %8.3f seconds' % ('wall clock', wall_clock))
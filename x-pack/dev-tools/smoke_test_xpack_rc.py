@@ -8,7 +8,34 @@
 #
 # USAGE:
 #
-# python3 -B ./dev-tools/smoke_test_rc.py --version 5.0.0-beta1 --hash bfa3e47
+# PYTHONPATH=dev-tools python3 -B ./x-pack/dev-tools/smoke_test_xpack_rc.py --version 5.0.0-beta1 --hash bfa3e47
+#
+# Several artifacts can be smoke-tested concurrently, each in its own temp dir
+# and on its own ports, by repeating --version/--hash (or --fetch_url for
+# several artifacts of one version) and passing --parallel:
+#
+# PYTHONPATH=dev-tools python3 -B ./x-pack/dev-tools/smoke_test_xpack_rc.py -v 5.0.0-beta1 -r bfa3e47 -v 5.0.0-beta2 -r 1a2b3c4 --parallel 2
+#
+# With --benchmark the startup time, time to green, request latencies and the
+# memory of the node are written as JSON and compared with a previous RC:
+#
+# PYTHONPATH=dev-tools python3 -B ./x-pack/dev-tools/smoke_test_xpack_rc.py -v 5.0.0-beta2 -r 1a2b3c4 --benchmark 200 --baseline beta1.json --benchmark_output beta2.json
+#
+# Downloads are verified against the published .sha512 checksum and kept in a
+# local cache (see --cache_dir and --cache_size), so re-runs start right away.
+#
+# With --nodes the RC is smoke tested on a local cluster instead: once formed
+# a synthetic dataset is bulk indexed (see --docs), searches are timed and the
+# nodes are restarted one at a time while the dataset is queried continuously:
+#
+# PYTHONPATH=dev-tools python3 -B ./x-pack/dev-tools/smoke_test_xpack_rc.py -v 5.0.0-beta2 -r 1a2b3c4 --nodes 3 --docs 100000
+#
+# Each artifact's download, extraction and smoke test are tasks of a graph
+# (see dev-tools/release_tasks.py, hence the PYTHONPATH above): downloads
+# and extractions overlap with the running nodes, of which at most --parallel
+# run at a time. --trace writes the timings of all tasks, and of the
+# commands, HTTP requests and node starts and stops within them, as a
+# Chrome trace.
 #
 
 import argparse
@@ -16,12 +43,30 @@ import tempfile
 import os
 import signal
 import shutil
+import zipfile
 import urllib
 import urllib.request
 import time
 import json
 import base64
-from http.client import HTTPConnection
+import collections
+import contextlib
+import functools
+import hashlib
+import math
+import queue
+import subprocess
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from http.client import HTTPConnection, HTTPException
+
+try:
+  from release_tasks import TaskRunner, in_span, span, write_trace
+except ImportError:
+  raise RuntimeError("""
+  Please put the release tooling's dev-tools directory on PYTHONPATH before running the smoke tests
+  From the repository root use: export PYTHONPATH=dev-tools""")
 
 # in case of debug, uncomment
 # HTTPConnection.debuglevel = 4
@@ -38,7 +83,8 @@ def java_exe():
   return 'export JAVA_HOME="%s" PATH="%s/bin:$PATH" JAVACMD="%s/bin/java"' % (path, path, path)
 
 def verify_java_version(version):
-  s = os.popen('%s; java -version 2>&1' % java_exe()).read()
+  with span('java -version', 'subprocess'):
+    s = os.popen('%s; java -version 2>&1' % java_exe()).read()
   if ' version "%s.' % version not in s:
     raise RuntimeError('got wrong version for java %s:\n%s' % (version, s))
 
@@ -46,126 +92,923 @@ def read_fully(file):
   with open(file, encoding='utf-8') as f:
      return f.read()
 
-def wait_for_node_startup(es_dir, timeout=60, headers={}):
-  print('     Waiting until node becomes available for at most %s seconds' % timeout)
-  for _ in range(timeout):
-    conn = None
+# Waits for the node to write its http ports file and returns
+# the first published address, or None if the deadline passes.
+# The file is written atomically by the node, so a cheap stat
+# backing off from 50ms to 1s is enough to notice it early.
+def wait_for_ports_file(es_dir, deadline):
+  ports_file = os.path.join(es_dir, 'logs/http.ports')
+  delay = 0.05
+  while True:
     try:
-      time.sleep(1)
-      host = get_host_from_ports_file(es_dir)
-      conn = HTTPConnection(host, timeout=1)
-      conn.request('GET', '/', headers=headers)
-      res = conn.getresponse()
-      if res.status == 200:
-        return True
-    except IOError as e:
+      if os.stat(ports_file).st_size > 0:
+        return get_host_from_ports_file(es_dir)
+    except (IOError, IndexError):
       pass
       #that is ok it might not be there yet
-    finally:
-      if conn:
-        conn.close()
-  return False
+    remaining = deadline - time.time()
+    if remaining <= 0:
+      return None
+    time.sleep(min(delay, remaining))
+    delay = min(delay * 2, 1)
+
+def wait_for_node_startup(es_dir, timeout=60, headers={}):
+  print('     Waiting until node becomes available for at most %s seconds' % timeout)
+  deadline = time.time() + timeout
+  with span('wait for ports file', 'io'):
+    host = wait_for_ports_file(es_dir, deadline)
+  if host is None:
+    return False
+  # probe over one connection; it transparently reconnects after a failure
+  conn = HTTPConnection(host, timeout=1)
+  delay = 0.05
+  try:
+    with span('GET / until available', 'http', host=host) as trace_args:
+      trace_args['probes'] = 0
+      while True:
+        trace_args['probes'] += 1
+        try:
+          conn.request('GET', '/', headers=headers)
+          res = conn.getresponse()
+          res.read()
+          if res.status == 200:
+            return True
+        except (IOError, HTTPException):
+          conn.close()
+          #that is ok it might not be there yet
+        remaining = deadline - time.time()
+        if remaining <= 0:
+          return False
+        time.sleep(min(delay, remaining))
+        delay = min(delay * 2, 1)
+  finally:
+    conn.close()
+
+# Blocks until the cluster reaches the given health status
+# and, if given, number of nodes, letting the node do the
+# waiting. Returns False on timeout.
+def wait_for_cluster_health(host, status='green', timeout=60, headers={}, nodes=None):
+  print('     Waiting for cluster health [%s] for at most %s seconds' % (status, timeout))
+  conn = HTTPConnection(host, timeout=timeout + 5)
+  path = '/_cluster/health?wait_for_status=%s&timeout=%ss' % (status, timeout)
+  if nodes:
+    path += '&wait_for_nodes=%d' % nodes
+  try:
+    with span('GET ' + path, 'http', host=host) as trace_args:
+      conn.request('GET', path, headers=headers)
+      res = conn.getresponse()
+      body = res.read()
+      trace_args['status'] = res.status
+    return res.status == 200 and not json.loads(body.decode('utf-8'))['timed_out']
+  finally:
+    conn.close()
+
+# A pool of keep-alive connections to one host. Connections
+# are created lazily, up to `size` of them, and handed out
+# to one thread at a time.
+class ConnectionPool:
+
+  def __init__(self, host, size=4, timeout=20, headers={}):
+    self.host = host
+    self.size = size
+    self.timeout = timeout
+    self.headers = headers
+    self.idle = queue.LifoQueue()
+    self.permits = threading.BoundedSemaphore(size)
+
+  @contextlib.contextmanager
+  def connection(self):
+    with self.permits:
+      try:
+        conn = self.idle.get_nowait()
+      except queue.Empty:
+        conn = HTTPConnection(self.host, timeout=self.timeout)
+      try:
+        yield conn
+      except BaseException:
+        conn.close() # the connection might be mid-response, don't reuse it
+        raise
+      self.idle.put(conn)
+
+  # Issues a request on a pooled connection and returns the
+  # status and the JSON decoded body (None if not JSON).
+  def request(self, method, path, body=None, headers={}):
+    with span('%s %s' % (method, path), 'http', host=self.host) as trace_args, self.connection() as conn:
+      conn.request(method, path, body=body, headers=dict(self.headers, **headers))
+      res = conn.getresponse()
+      data = res.read()
+      trace_args['status'] = res.status
+    try:
+      return res.status, json.loads(data.decode('utf-8'))
+    except ValueError:
+      return res.status, None
+
+  def close(self):
+    while not self.idle.empty():
+      self.idle.get_nowait().close()
+
+# A smoke check: `verify` is handed the JSON response of
+# GET `path` and the release and raises a RuntimeError if
+# the response isn't as expected.
+Check = collections.namedtuple('Check', ['name', 'path', 'verify'])
+
+# checks run against every smoke tested node, see smoke_check
+CHECKS = []
+
+# Registers the decorated function as a check of the
+# response of GET `path`.
+def smoke_check(name, path):
+  def register(verify):
+    CHECKS.append(Check(name, path, verify))
+    return verify
+  return register
+
+@smoke_check('version', '/')
+def check_version(response, release):
+  if response['version']['number'] != release:
+    raise RuntimeError('expected version %s, was %s' % (release, response['version']['number']))
+
+@smoke_check('health', '/_cluster/health')
+def check_health(response, release):
+  if response['status'] != 'green':
+    raise RuntimeError('expected cluster health green, was %s' % response['status'])
+
+# check if plugin is loaded
+@smoke_check('plugins', '/_nodes/plugins')
+def check_xpack_plugin(response, release):
+  for _, node in response['nodes'].items():
+    for node_plugin in node['plugins']:
+      if node_plugin['name'] != 'x-pack':
+        raise RuntimeError('Unexpected plugin %s, expected x-pack only' % node_plugin['name'])
+
+# check if license is the default one
+@smoke_check('license', '/_xpack')
+def check_trial_license(response, release):
+  license = response['license']
+  if license['type'] != 'trial':
+    raise RuntimeError('expected license type to be trial, was %s' % license['type'])
+  if license['mode'] != 'trial':
+    raise RuntimeError('expected license mode to be trial, was %s' % license['mode'])
+  if license['status'] != 'active':
+    raise RuntimeError('expected license status to be active, was %s' % license['status'])
+
+# Runs the given checks concurrently over the connection
+# pool. Returns a list of (name, seconds, error) tuples in
+# the order of the checks, error being None on success.
+def run_checks(pool, checks, release):
+  def run_check(check):
+    started_at = time.time()
+    try:
+      status, response = pool.request('GET', check.path)
+      if status != 200:
+        raise RuntimeError('Expected HTTP 200 but got %s' % status)
+      check.verify(response, release)
+      return (check.name, time.time() - started_at, None)
+    except Exception as e:
+      return (check.name, time.time() - started_at, '%s: %s' % (type(e).__name__, e))
+
+  with ThreadPoolExecutor(max_workers=max(1, len(checks))) as executor:
+    results = list(executor.map(in_span(run_check), checks))
+  for name, took, error in results:
+    print('     Check [%s] %s in %.1f ms' % (name, 'failed: %s' % error if error else 'passed', took * 1000))
+  return results
+
+BENCHMARK_PATHS = ['/', '/_nodes', '/_xpack']
+
+# Returns the given percentile of the values (nearest rank).
+def percentile(values, p):
+  ordered = sorted(values)
+  return ordered[max(0, math.ceil(p / 100 * len(ordered)) - 1)]
+
+# Sends `count` GET requests to each of the paths through the
+# pool and returns the p50/p99 latencies in ms per path.
+def benchmark_requests(pool, paths, count):
+  def timed_request(path):
+    started_at = time.time()
+    status, _ = pool.request('GET', path)
+    if status != 200:
+      raise RuntimeError('Expected HTTP 200 for %s but got %s' % (path, status))
+    return time.time() - started_at
 
-def download_release(version, release_hash, url):
+  latencies = {}
+  with ThreadPoolExecutor(max_workers=pool.size) as executor:
+    for path in paths:
+      took = [t * 1000 for t in executor.map(in_span(timed_request), [path] * count)]
+      latencies[path] = { 'p50_ms': percentile(took, 50), 'p99_ms': percentile(took, 99) }
+  return latencies
+
+# Returns the resident set size of the given process in MB.
+def process_rss_mb(pid):
+  try:
+    with open('/proc/%d/status' % pid, encoding='utf-8') as status:
+      for line in status:
+        if line.startswith('VmRSS:'):
+          return int(line.split()[1]) / 1024
+  except IOError:
+    pass
+  # no procfs (e.g. on macOS)
+  with span('ps -o rss= -p %d' % pid, 'subprocess'):
+    return int(subprocess.check_output(['ps', '-o', 'rss=', '-p', str(pid)]).decode('utf-8').strip()) / 1024
+
+# Flattens a benchmark result into {metric: value}, leaving
+# out the metrics it lacks (e.g. a --nodes result has none of
+# the single node's); all metrics are "lower is better".
+def benchmark_metrics(result):
+  metrics = { name: result[name] for name in ('startup_seconds', 'green_seconds', 'rss_mb')
+              if isinstance(result.get(name), (int, float)) }
+  for path, latency in (result.get('latency') or {}).items():
+    for name, value in latency.items():
+      metrics['%s %s' % (path, name)] = value
+  return metrics
+
+# Compares a benchmark result with the baseline and returns
+# the metrics that got worse by more than `threshold` percent
+# as (metric, baseline, current) tuples. Metrics missing from
+# the baseline are skipped with a warning.
+def benchmark_regressions(result, baseline, threshold):
+  current = benchmark_metrics(result)
+  previous = benchmark_metrics(baseline)
+  missing = sorted(set(current) - set(previous))
+  if missing:
+    print('  WARNING: baseline has no %s, not comparable' % ', '.join(missing))
+  return [(metric, previous[metric], value) for metric, value in sorted(current.items())
+          if metric in previous and value > previous[metric] * (1 + threshold / 100)]
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'elasticsearch-smoke-tests')
+DEFAULT_CACHE_SIZE_MB = 4096
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+# guards the per-artifact locks that keep concurrent runs from downloading the same file twice
+cache_locks_lock = threading.Lock()
+cache_locks = {}
+
+def cache_lock(path):
+  with cache_locks_lock:
+    return cache_locks.setdefault(path, threading.Lock())
+
+# Returns the expected SHA-512 of the artifact at the given url as published
+# next to it, or None if there is no checksum file.
+def fetch_sha512(url):
+  try:
+    with span('GET %s.sha512' % url, 'http'), urllib.request.urlopen(url + '.sha512') as res:
+      return res.read().decode('utf-8').split()[0].lower()
+  except (IOError, IndexError):
+    return None
+
+# Streams the given url into path in chunks, computing the SHA-512 on the fly.
+# A partial download left over from a previous attempt is resumed with a range
+# request if the server supports it and restarted otherwise.
+def stream_download(url, path):
+  part_path = path + '.part'
+  sha512 = hashlib.sha512()
+  offset = 0
+  if os.path.exists(part_path):
+    with open(part_path, 'rb') as part:
+      for chunk in iter(lambda: part.read(DOWNLOAD_CHUNK_SIZE), b''):
+        sha512.update(chunk)
+        offset += len(chunk)
+  request = urllib.request.Request(url)
+  if offset and url.startswith('http'):
+    request.add_header('Range', 'bytes=%d-' % offset)
+  with span('GET %s' % url, 'http', offset=offset) as trace_args, urllib.request.urlopen(request) as res:
+    if offset and getattr(res, 'status', None) != 206:
+      print('  Cannot resume download of %s, restarting' % url)
+      sha512 = hashlib.sha512()
+      offset = 0
+    elif offset:
+      print('  Resuming download of %s at %d bytes' % (url, offset))
+    with open(part_path, 'ab' if offset else 'wb') as part:
+      for chunk in iter(lambda: res.read(DOWNLOAD_CHUNK_SIZE), b''):
+        sha512.update(chunk)
+        part.write(chunk)
+        offset += len(chunk)
+    trace_args['bytes'] = offset
+  return part_path, sha512.hexdigest()
+
+# Returns the path of the given artifact in the local cache, downloading it
+# first if it isn't there yet. Entries are keyed by version, hash and url, as
+# several urls may serve artifacts of the same version and file name. The
+# SHA-512 is checked against `sha512`, or the checksum published next to the
+# url, before the download is moved into the cache, and again against the one
+# stored with a cached artifact before it's reused.
+def fetch_artifact(version, release_hash, url, cache_dir, sha512=None):
+  file = os.path.basename(urllib.parse.urlparse(url).path)
+  if not file.endswith('.zip'):
+    file = 'elasticsearch-%s.zip' % version
+  url_digest = hashlib.sha1(url.encode('utf-8')).hexdigest()[:12]
+  entry_dir = os.path.join(cache_dir, '%s-%s-%s' % (version, release_hash, url_digest))
+  artifact_path = os.path.join(entry_dir, file)
+  with cache_lock(artifact_path):
+    expected = sha512.lower() if sha512 else fetch_sha512(url)
+    if os.path.isfile(artifact_path) and os.path.isfile(artifact_path + '.sha512'):
+      cached = read_fully(artifact_path + '.sha512').split()[0].lower()
+      if expected is None or cached == expected:
+        print('  Using cached %s' % artifact_path)
+        os.utime(entry_dir) # marks the entry as recently used for the eviction
+        return artifact_path
+      print('  Cached %s doesn\'t match the expected SHA-512, downloading it again' % artifact_path)
+      os.remove(artifact_path + '.sha512')
+      os.remove(artifact_path)
+    os.makedirs(entry_dir, exist_ok=True)
+    if expected is None:
+      print('  WARNING: no SHA-512 checksum published for %s, skipping verification' % url)
+    started_at = time.time()
+    part_path, actual = stream_download(url, artifact_path)
+    if expected is not None and actual != expected:
+      os.remove(part_path)
+      raise RuntimeError('SHA-512 mismatch for %s: expected %s but got %s' % (url, expected, actual))
+    with open(artifact_path + '.sha512', 'w', encoding='utf-8') as checksum:
+      checksum.write('%s  %s\n' % (actual, file))
+    os.replace(part_path, artifact_path)
+    os.utime(entry_dir)
+    print('  Downloaded %d MB in %.1f seconds' % (os.path.getsize(artifact_path) // (1024 * 1024), time.time() - started_at))
+    return artifact_path
+
+# Removes the least recently used cache entries until the cache holds at most
+# max_bytes. The entries listed in `keep` are never removed.
+def evict_cache(cache_dir, max_bytes, keep=()):
+  entries = []
+  for name in os.listdir(cache_dir):
+    entry_dir = os.path.join(cache_dir, name)
+    if os.path.isdir(entry_dir):
+      size = sum(os.path.getsize(os.path.join(root, f)) for root, _, files in os.walk(entry_dir) for f in files)
+      entries.append((os.path.getmtime(entry_dir), size, entry_dir))
+  total = sum(size for _, size, _ in entries)
+  for _, size, entry_dir in sorted(entries):
+    if total <= max_bytes:
+      break
+    if entry_dir in keep:
+      continue
+    print('  Evicting %s from the download cache' % entry_dir)
+    shutil.rmtree(entry_dir, ignore_errors=True)
+    total -= size
+
+# Downloads (or takes from the cache) the release and smoke tests it. Without
+# a cache dir the artifact is downloaded into a temp dir that is removed after.
+# With `cluster_args` the release is smoke tested on a cluster instead,
+# see smoke_test_cluster which they're passed on to.
+def download_release(version, release_hash, url, http_port=None, transport_port=None,
+                     cache_dir=DEFAULT_CACHE_DIR, cache_size_mb=DEFAULT_CACHE_SIZE_MB, sha512=None, benchmark=0,
+                     trace_path=None, cluster_args=None):
   print('Downloading release %s from %s' % (version, url))
-  tmp_dir = tempfile.mkdtemp()
+  runner = TaskRunner(workers=2, limits={ 'node': 1 })
   try:
-    downloaded_files = []
-    print('  ' + '*' * 80)
+    smoke_tests = run_smoke_tests(runner, [(version, release_hash, url, http_port, transport_port)], cache_dir,
+                                  cache_size_mb, sha512, benchmark, cluster_args=cluster_args)
+  finally:
+    if trace_path:
+      write_trace(trace_path)
+  print('  SUCCESS')
+  return [runner.results[smoke_tests[0].name]]
+
+# Adds the tasks smoke testing an artifact to the runner: its download
+# (or cache lookup), the extraction of the distribution and the smoke
+# test of a node running from it, which is in the runner's 'node' group.
+# The extraction's temp dir is added to `tmp_dirs` for the caller to
+# remove. Given `cluster_args` the smoke test runs on a cluster, see
+# smoke_test_cluster. Returns the download and the smoke test tasks.
+def add_artifact_tasks(runner, label, version, release_hash, url, tmp_dirs, http_port=None, transport_port=None,
+                       cache_dir=DEFAULT_CACHE_DIR, sha512=None, benchmark=0, cluster_args=None):
+  def download():
     print('  Downloading %s' % (url))
-    file = ('elasticsearch-%s.zip' % version)
-    artifact_path = os.path.join(tmp_dir, file)
-    downloaded_files.append(artifact_path)
-    urllib.request.urlretrieve(url, os.path.join(tmp_dir, file))
-    print('  ' + '*' * 80)
-    print()
-    
-    smoke_test_release(version, downloaded_files, release_hash)
-    print('  SUCCESS')
+    return fetch_artifact(version, release_hash, url, cache_dir, sha512)
+  def extract(artifact_path):
+    dist_tmp_dir = tempfile.mkdtemp()
+    tmp_dirs.append(dist_tmp_dir)
+    print('  Extracting [%s]' % artifact_path)
+    extract_zip(artifact_path, dist_tmp_dir)
+    return os.path.join(dist_tmp_dir, 'elasticsearch-%s' % (version))
+  artifact = runner.add('download %s' % label, download)
+  dist_dir = runner.add('extract %s' % label, extract, artifact)
+  if cluster_args:
+    smoke_test = runner.add('smoke test %s' % label, functools.partial(smoke_test_cluster, **cluster_args), version,
+                            artifact, release_hash, dist_dir, group='node')
+  else:
+    smoke_test = runner.add('smoke test %s' % label, smoke_test_artifact, version, artifact, release_hash, http_port,
+                            transport_port, dist_dir, benchmark, group='node')
+  return artifact, smoke_test
+
+# Runs the tasks smoke testing the given (version, hash, url, http port,
+# transport port) artifacts, evicting the least recently used entries from
+# the download cache once all are downloaded. Returns the smoke test tasks,
+# in the order of the artifacts.
+def run_smoke_tests(runner, artifacts, cache_dir=DEFAULT_CACHE_DIR, cache_size_mb=DEFAULT_CACHE_SIZE_MB, sha512=None,
+                    benchmark=0, fail_fast=True, cluster_args=None):
+  tmp_dirs = []
+  use_cache = bool(cache_dir)
+  if not use_cache:
+    cache_dir = tempfile.mkdtemp()
+    tmp_dirs.append(cache_dir)
+  try:
+    downloads, smoke_tests = [], []
+    for i, (version, release_hash, url, http_port, transport_port) in enumerate(artifacts):
+      label = version if len(artifacts) == 1 else '%s [%d]' % (version, i)
+      download, smoke_test = add_artifact_tasks(runner, label, version, release_hash, url, tmp_dirs, http_port,
+                                                transport_port, cache_dir, sha512, benchmark, cluster_args)
+      downloads.append(download)
+      smoke_tests.append(smoke_test)
+    if use_cache:
+      runner.add('evict cache', lambda *paths: evict_cache(cache_dir, cache_size_mb * 1024 * 1024,
+                                                           keep=[os.path.dirname(path) for path in paths]), *downloads)
+    runner.run(fail_fast)
+    return smoke_tests
   finally:
-    shutil.rmtree(tmp_dir)
+    for tmp_dir in tmp_dirs:
+      shutil.rmtree(tmp_dir, ignore_errors=True)
 
 def get_host_from_ports_file(es_dir):
   return read_fully(os.path.join(es_dir, 'logs/http.ports')).splitlines()[0]
 
-def smoke_test_release(release, files, release_hash):
-  for release_file in files:
-    if not os.path.isfile(release_file):
-      raise RuntimeError('Smoketest failed missing file %s' % (release_file))
-    tmp_dir = tempfile.mkdtemp()
-    run('unzip %s -d %s' % (release_file, tmp_dir))
-    
-    es_dir = os.path.join(tmp_dir, 'elasticsearch-%s' % (release))
-    es_run_path = os.path.join(es_dir, 'bin/elasticsearch')
-    
-    print('  Smoke testing package [%s]' % release_file)
-    es_plugin_path = os.path.join(es_dir, 'bin/elasticsearch-plugin')
-    
-    print('     Install xpack [%s]')
-    run('%s; ES_JAVA_OPTS="-Des.plugins.staging=%s" %s install -b x-pack' % (java_exe(), release_hash, es_plugin_path))
-    headers = { 'Authorization' : 'Basic %s' % base64.b64encode(b"es_admin:foobar").decode("UTF-8") }
-    es_shield_path = os.path.join(es_dir, 'bin/x-pack/users')
-    
+# Extracts the given zip into dest_dir with `workers` threads, each reading
+# through its own handle. The unix file modes stored in the zip are restored,
+# so the scripts under bin/ stay executable.
+def extract_zip(zip_path, dest_dir, workers=4):
+  with span('extract %s' % os.path.basename(zip_path), 'io', workers=workers):
+    with zipfile.ZipFile(zip_path) as zip_file:
+      members = zip_file.infolist()
+    # create the directories upfront so the workers don't race creating them
+    for member in members:
+      path = os.path.join(dest_dir, *member.filename.rstrip('/').split('/'))
+      os.makedirs(path if member.is_dir() else os.path.dirname(path), exist_ok=True)
+    def extract(chunk):
+      with zipfile.ZipFile(zip_path) as zip_file:
+        for member in chunk:
+          path = zip_file.extract(member, dest_dir)
+          mode = (member.external_attr >> 16) & 0o7777
+          if mode and not member.is_dir():
+            os.chmod(path, mode)
+    files = [m for m in members if not m.is_dir()]
+    chunks = [files[i::workers] for i in range(workers) if files[i::workers]]
+    with ThreadPoolExecutor(max_workers=max(1, len(chunks))) as executor:
+      for future in [executor.submit(extract, chunk) for chunk in chunks]:
+        future.result()
+
+# Clones the tree at src_dir into dest_dir by hard-linking its files, which is
+# much cheaper than extracting the distribution again. The node and the tools
+# rewrite files under the `copy_dirs` (relative to src_dir), so those get real
+# copies to keep the source tree pristine. Falls back to copying if the dirs
+# are on different file systems.
+def link_tree(src_dir, dest_dir, copy_dirs=('config',)):
+  copy_prefixes = tuple(os.path.join(src_dir, d) + os.sep for d in copy_dirs)
+  def link_or_copy(src, dst):
+    if not src.startswith(copy_prefixes):
+      try:
+        os.link(src, dst)
+        return dst
+      except OSError:
+        pass
+    return shutil.copy2(src, dst)
+  with span('link tree %s' % os.path.basename(dest_dir), 'io'):
+    shutil.copytree(src_dir, dest_dir, symlinks=True, copy_function=link_or_copy)
+
+# credentials of the superuser added to every smoke tested node
+HEADERS = { 'Authorization' : 'Basic %s' % base64.b64encode(b"es_admin:foobar").decode("UTF-8") }
+
+# Manages a node running from a hard-linked copy of an extracted
+# distribution. x-pack and the smoke test user are installed once when
+# entering the context, after which the node can be started and stopped
+# repeatedly. snapshot() saves the data path and reset() restores it, so
+# several scenarios can run against the same state without installing a
+# new node each time. Leaving the context always stops the node and
+# removes its directory.
+class SmokeNode:
+
+  def __init__(self, release, release_hash, dist_dir, work_dir=None, node_name='smoke_tester',
+               cluster_name='prepare_release', http_port=None, transport_port=None, settings=()):
+    self.release_hash = release_hash
+    self.dist_dir = dist_dir
+    self.work_dir = work_dir or tempfile.mkdtemp()
+    self.es_dir = os.path.join(self.work_dir, 'elasticsearch-%s' % (release))
+    self.data_dir = os.path.join(self.es_dir, 'data')
+    self.snapshot_dir = os.path.join(self.work_dir, 'data-snapshot')
+    self.pid_path = os.path.join(self.es_dir, 'es-smoke.pid')
+    self.log_path = os.path.join(self.es_dir, 'logs/%s.log' % cluster_name)
+    self.settings = ['-Enode.name=%s' % node_name, '-Ecluster.name=%s' % cluster_name,
+                     '-Erepositories.url.allowed_urls=http://snapshot.test*', '-Epath.data=%s' % self.data_dir]
+    if http_port:
+      self.settings.append('-Ehttp.port=%s' % http_port)
+    if transport_port:
+      self.settings.append('-Etransport.port=%s' % transport_port)
+    self.settings.extend(settings)
+    self.host = None
+    self.pid = None
+
+  def __enter__(self):
+    try:
+      self.install()
+    except BaseException:
+      self.cleanup()
+      raise
+    return self
+
+  def __exit__(self, *exc_info):
+    self.cleanup()
+
+  def install(self):
+    link_tree(self.dist_dir, self.es_dir)
+    es_plugin_path = os.path.join(self.es_dir, 'bin/elasticsearch-plugin')
+    print('     Install xpack [%s]' % self.es_dir)
+    run('%s; ES_JAVA_OPTS="-Des.plugins.staging=%s" %s install -b x-pack' % (java_exe(), self.release_hash, es_plugin_path))
+    es_shield_path = os.path.join(self.es_dir, 'bin/x-pack/users')
     print("     Install dummy shield user")
     run('%s; %s  useradd es_admin -r superuser -p foobar' % (java_exe(), es_shield_path))
-    
-    print('  Starting elasticsearch daemon from [%s]' % es_dir)
-    try:
-      run('%s; %s -Enode.name=smoke_tester -Ecluster.name=prepare_release -Erepositories.url.allowed_urls=http://snapshot.test* %s -Epidfile=%s -Enode.portsfile=true'
-          % (java_exe(), es_run_path, '-d', os.path.join(es_dir, 'es-smoke.pid')))
-      if not wait_for_node_startup(es_dir, headers=headers):
+
+  # Starts the node and waits for it to answer and for the cluster
+  # to reach `health`. Returns the seconds from launch until the
+  # node answered and until the cluster reached the health.
+  def start(self, timeout=60, health='green'):
+    with span('start node', 'node', es_dir=self.es_dir):
+      print('  Starting elasticsearch daemon from [%s]' % self.es_dir)
+      ports_file = os.path.join(self.es_dir, 'logs/http.ports')
+      if os.path.exists(ports_file): # left over from a previous start
+        os.remove(ports_file)
+      launched_at = time.time()
+      run('%s; %s %s -d -Epidfile=%s -Enode.portsfile=true'
+          % (java_exe(), os.path.join(self.es_dir, 'bin/elasticsearch'), ' '.join(self.settings), self.pid_path))
+      if not wait_for_node_startup(self.es_dir, timeout=timeout, headers=HEADERS):
         print("elasticsearch logs:")
         print('*' * 80)
-        logs = read_fully(os.path.join(es_dir, 'logs/prepare_release.log'))
-        print(logs)
+        print(read_fully(self.log_path) if os.path.exists(self.log_path) else '<no log file>')
         print('*' * 80)
         raise RuntimeError('server didn\'t start up')
-      try: # we now get / and /_nodes to fetch basic infos like hashes etc and the installed plugins
-        host = get_host_from_ports_file(es_dir)
-        conn = HTTPConnection(host, timeout=20)
-        
-        # check if plugin is loaded
-        conn.request('GET', '/_nodes/plugins?pretty=true', headers=headers)
-        res = conn.getresponse()
-        if res.status == 200:
-          nodes = json.loads(res.read().decode("utf-8"))['nodes']
-          for _, node in nodes.items():
-            node_plugins = node['plugins']
-            for node_plugin in node_plugins:
-              if node_plugin['name'] != 'x-pack':
-                raise RuntimeError('Unexpected plugin %s, expected x-pack only' % node_plugin['name'])
-        else:
-          raise RuntimeError('Expected HTTP 200 but got %s' % res.status)
-
-        # check if license is the default one
-        # also sleep for few more seconds, as the initial license generation might take some time
-        time.sleep(5)
-        conn.request('GET', '/_xpack', headers=headers)
-        res = conn.getresponse()
-        if res.status == 200:
-          xpack = json.loads(res.read().decode("utf-8"))
-          if xpack['license']['type'] != 'trial':
-            raise RuntimeError('expected license type to be trial, was %s' % xpack['license']['type'])
-          if xpack['license']['mode'] != 'trial':
-            raise RuntimeError('expected license mode to be trial, was %s' % xpack['license']['mode'])
-          if xpack['license']['status'] != 'active':
-            raise RuntimeError('expected license status to be active, was %s' % xpack['license']['active'])
-        else:
-          raise RuntimeError('Expected HTTP 200 but got %s' % res.status)
-      
-      finally:
-        conn.close()
+      started_at = time.time()
+      # the pidfile is written during bootstrap, it's there once the node answers
+      self.pid = int(read_fully(self.pid_path))
+      self.host = get_host_from_ports_file(self.es_dir)
+      # the initial license generation happens while the cluster recovers
+      if health and not wait_for_cluster_health(self.host, status=health, timeout=timeout, headers=HEADERS):
+        raise RuntimeError('cluster didn\'t reach %s health' % health)
+      return started_at - launched_at, time.time() - launched_at
+
+  # Stops the node with SIGTERM, giving it `timeout` seconds to shut
+  # down gracefully before it is killed.
+  def stop(self, timeout=30):
+    if self.pid is None and os.path.exists(self.pid_path):
+      self.pid = int(read_fully(self.pid_path))
+    if self.pid is None:
+      return
+    with span('stop node', 'node', pid=self.pid):
+      print('  Stopping elasticsearch daemon [%d]' % self.pid)
+      try:
+        os.kill(self.pid, signal.SIGTERM)
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+          os.kill(self.pid, 0) # raises once the process is gone
+          time.sleep(0.1)
+        print('  Node did not stop within %s seconds, killing it' % timeout)
+        os.kill(self.pid, signal.SIGKILL)
+      except ProcessLookupError:
+        pass
+      self.pid = None
+      self.host = None
+      if os.path.exists(self.pid_path):
+        os.remove(self.pid_path)
+
+  # Saves the data path of the stopped node, e.g. while it's still
+  # empty before the first start.
+  def snapshot(self):
+    if os.path.exists(self.snapshot_dir):
+      shutil.rmtree(self.snapshot_dir)
+    os.makedirs(self.data_dir, exist_ok=True)
+    shutil.copytree(self.data_dir, self.snapshot_dir)
+
+  # Stops the node, restores the data path saved by snapshot() and
+  # starts it again.
+  def reset(self):
+    self.stop()
+    shutil.rmtree(self.data_dir, ignore_errors=True)
+    shutil.copytree(self.snapshot_dir, self.data_dir)
+    return self.start()
+
+  def cleanup(self):
+    try:
+      self.stop()
     finally:
-      pid_path = os.path.join(es_dir, 'es-smoke.pid')
-      if os.path.exists(pid_path): # try reading the pid and kill the node
-        pid = int(read_fully(pid_path))
-        os.kill(pid, signal.SIGKILL)
+      shutil.rmtree(self.work_dir, ignore_errors=True)
+
+# Returns the settings making the nodes with the given names and
+# transport ports discover each other and form a cluster: zen
+# unicast hosts before 7.0, seed hosts and the initial master
+# nodes from then on.
+def discovery_settings(release, node_names, transport_ports):
+  hosts = ','.join('127.0.0.1:%d' % port for port in transport_ports)
+  if int(release.split('.')[0]) < 7:
+    return ['-Ediscovery.zen.ping.unicast.hosts=%s' % hosts,
+            '-Ediscovery.zen.minimum_master_nodes=%d' % (len(node_names) // 2 + 1)]
+  return ['-Ediscovery.seed_hosts=%s' % hosts, '-Ecluster.initial_master_nodes=%s' % ','.join(node_names)]
+
+# Manages a cluster of `size` nodes running from the same extracted
+# distribution, each a SmokeNode with its own directory, data path,
+# ports file and ports: base_port + i for http and base_port + 100 + i
+# for transport. Leaving the context stops all nodes and removes
+# their directories.
+class SmokeCluster:
+
+  def __init__(self, release, release_hash, dist_dir, size, base_port=9400, cluster_name='prepare_release'):
+    names = ['smoke_tester_%d' % i for i in range(size)]
+    transport_ports = [base_port + 100 + i for i in range(size)]
+    settings = discovery_settings(release, names, transport_ports)
+    self.nodes = [SmokeNode(release, release_hash, dist_dir, node_name=name, cluster_name=cluster_name,
+                            http_port=base_port + i, transport_port=transport_ports[i], settings=settings)
+                  for i, name in enumerate(names)]
+
+  def __enter__(self):
+    try:
+      self.on_all_nodes(lambda node: node.install())
+    except BaseException:
+      self.cleanup()
+      raise
+    return self
+
+  def __exit__(self, *exc_info):
+    self.cleanup()
+
+  def on_all_nodes(self, func):
+    with ThreadPoolExecutor(max_workers=len(self.nodes)) as executor:
+      return [future.result() for future in [executor.submit(in_span(func), node) for node in self.nodes]]
+
+  # Starts all nodes at once, since the cluster only forms once enough
+  # master eligible nodes are up, and waits for all of them to join
+  # and the cluster to reach `health`. Returns the seconds it took.
+  def start(self, timeout=120, health='green'):
+    started_at = time.time()
+    self.on_all_nodes(lambda node: node.start(timeout, health=None))
+    self.wait_for_health(health, timeout)
+    return time.time() - started_at
+
+  def wait_for_health(self, health, timeout):
+    host = next(node.host for node in self.nodes if node.host)
+    if not wait_for_cluster_health(host, status=health, timeout=timeout, headers=HEADERS, nodes=len(self.nodes)):
+      raise RuntimeError('cluster didn\'t reach %s health with %d nodes' % (health, len(self.nodes)))
+
+  # Restarts the nodes one at a time, each time waiting for the node
+  # to rejoin and the cluster to get back to `health` before moving
+  # on. `on_stop` and `on_start` are called with the node before it
+  # is stopped and once it rejoined, as it can't serve requests
+  # before. Returns the seconds each
+  # node took from being stopped until the cluster recovered.
+  def rolling_restart(self, timeout=120, health='green', on_stop=None, on_start=None):
+    took = []
+    for node in self.nodes:
+      with span('restart %s' % node.es_dir, 'node'):
+        started_at = time.time()
+        if on_stop:
+          on_stop(node)
+        node.stop()
+        node.start(timeout, health=None)
+        self.wait_for_health(health, timeout)
+        if on_start:
+          on_start(node)
+        took.append(time.time() - started_at)
+    return took
+
+  def cleanup(self):
+    for node in self.nodes:
+      try:
+        node.cleanup()
+      except Exception:
+        traceback.print_exc()
+
+# Scenario running all registered smoke checks.
+def checks_scenario(node, pool, release):
+  # we now get / and /_nodes to fetch basic infos like hashes etc and the installed plugins
+  failures = [result for result in run_checks(pool, CHECKS, release) if result[2]]
+  if failures:
+    raise RuntimeError('%d smoke checks failed: %s' % (len(failures), '; '.join('%s: %s' % (name, error) for name, _, error in failures)))
+
+# Returns a scenario measuring the latencies of `requests` requests
+# per benchmarked endpoint and the memory of the node.
+def benchmark_scenario(requests):
+  def benchmark(node, pool, release):
+    print('     Benchmarking %d requests per endpoint' % requests)
+    return { 'latency': benchmark_requests(pool, BENCHMARK_PATHS, requests), 'rss_mb': process_rss_mb(node.pid) }
+  return benchmark
+
+# index holding the synthetic dataset of the cluster scenario
+CLUSTER_INDEX = 'smoke-test'
+CLUSTER_SEARCH_PATHS = ['/%s/_search?q=tag:tag-1' % CLUSTER_INDEX,
+                        '/%s/_search?q=value:%%5B100+TO+200%%5D&size=50' % CLUSTER_INDEX]
+
+# Returns the `count` documents of the synthetic dataset, the same on
+# every run so results stay comparable across release candidates.
+def synthetic_docs(count):
+  for i in range(count):
+    yield { 'id': i, 'tag': 'tag-%d' % (i % 10), 'value': (i * 7919) % 1000, 'message': 'synthetic document %d' % i }
+
+# Creates the dataset's index with a shard per node and a replica, so
+# that it stays available while a node is down, and bulk indexes
+# `docs` documents in requests of `bulk_size`. Returns the seconds
+# it took, including the final refresh.
+def index_dataset(pool, release, docs, bulk_size, shards):
+  json_headers = { 'Content-Type': 'application/json' }
+  settings = { 'settings': { 'number_of_shards': shards, 'number_of_replicas': min(1, shards - 1) } }
+  status, response = pool.request('PUT', '/' + CLUSTER_INDEX, json.dumps(settings), json_headers)
+  if status != 200:
+    raise RuntimeError('failed to create index %s: %s' % (CLUSTER_INDEX, response))
+  # mapping types are gone from 7.0 on
+  bulk_path = '/%s/_bulk' % CLUSTER_INDEX if int(release.split('.')[0]) >= 7 else '/%s/doc/_bulk' % CLUSTER_INDEX
+  started_at = time.time()
+  batch = []
+  def flush():
+    body = ''.join('{"index":{}}\n%s\n' % json.dumps(doc) for doc in batch)
+    status, response = pool.request('POST', bulk_path, body.encode('utf-8'), { 'Content-Type': 'application/x-ndjson' })
+    if status != 200 or response.get('errors'):
+      raise RuntimeError('bulk request failed with HTTP %s' % status)
+    batch.clear()
+  for doc in synthetic_docs(docs):
+    batch.append(doc)
+    if len(batch) >= bulk_size:
+      flush()
+  if batch:
+    flush()
+  pool.request('POST', '/%s/_refresh' % CLUSTER_INDEX)
+  return time.time() - started_at
+
+# Counts the dataset through the nodes that are up, round robin, every
+# `interval` seconds until stopped. A query is available if it returns
+# the full count; a node is marked down before it's stopped, and no
+# query is in flight to it by then.
+class AvailabilityProbe:
+
+  def __init__(self, nodes, expected, interval=0.05):
+    self.pools = { node: ConnectionPool(node.host, size=1, timeout=5, headers=HEADERS) for node in nodes }
+    self.up = list(nodes)
+    self.expected = expected
+    self.interval = interval
+    self.lock = threading.Lock()
+    self.stopped = threading.Event()
+    self.queries = 0
+    self.failed = 0
+    self.thread = threading.Thread(target=in_span(self.run), daemon=True)
+
+  def mark_down(self, node):
+    with self.lock:
+      self.up.remove(node)
+      self.pools[node].close() # its connections won't survive the restart
+
+  def mark_up(self, node):
+    with self.lock:
+      self.up.append(node)
+
+  def run(self):
+    i = 0
+    while not self.stopped.wait(self.interval):
+      with self.lock:
+        if not self.up:
+          continue
+        node = self.up[i % len(self.up)]
+        i += 1
+        try:
+          status, response = self.pools[node].request('GET', '/%s/_count' % CLUSTER_INDEX)
+          available = status == 200 and response['count'] == self.expected
+        except (IOError, HTTPException, KeyError, TypeError):
+          available = False
+        self.queries += 1
+        self.failed += 0 if available else 1
+
+  def start(self):
+    self.thread.start()
+
+  # Stops probing and returns the (queries, failed queries).
+  def stop(self):
+    self.stopped.set()
+    self.thread.join()
+    for pool in self.pools.values():
+      pool.close()
+    return self.queries, self.failed
+
+# Smoke tests a release zip on a cluster of `nodes` nodes: the smoke
+# checks run once it formed, then `docs` synthetic documents are bulk
+# indexed and the latencies of `requests` searches per query measured.
+# Last the nodes are restarted one at a time while the dataset is
+# counted continuously. Returns the formation time, the indexing
+# throughput, the search latencies and the query availability and
+# recovery times during the rolling restart.
+def smoke_test_cluster(release, release_file, release_hash, dist_dir, nodes=3, docs=10000, bulk_size=1000, requests=100,
+                       base_port=9400):
+  print('  Smoke testing package [%s] on a %d node cluster' % (release_file, nodes))
+  with SmokeCluster(release, release_hash, dist_dir, nodes, base_port) as cluster:
+    formation_seconds = cluster.start()
+    pool = ConnectionPool(cluster.nodes[0].host, headers=HEADERS)
+    try:
+      with span('scenario checks', 'scenario'):
+        checks_scenario(cluster.nodes[0], pool, release)
+      print('     Indexing %d documents' % docs)
+      with span('scenario indexing', 'scenario', docs=docs, bulk_size=bulk_size):
+        indexing_seconds = index_dataset(pool, release, docs, bulk_size, nodes)
+      print('     Benchmarking %d searches per query' % requests)
+      with span('scenario search', 'scenario'):
+        search = benchmark_requests(pool, CLUSTER_SEARCH_PATHS, requests)
+    finally:
+      pool.close()
+    print('     Restarting the nodes one at a time')
+    probe = AvailabilityProbe(cluster.nodes, docs)
+    probe.start()
+    try:
+      with span('scenario rolling restart', 'scenario'):
+        restart_seconds = cluster.rolling_restart(on_stop=probe.mark_down, on_start=probe.mark_up)
+    finally:
+      queries, failed = probe.stop()
+  print('  ' + '*' * 80)
+  print()
+  return { 'version': release, 'artifact': os.path.basename(release_file), 'nodes': nodes,
+           'formation_seconds': formation_seconds,
+           'indexing': { 'docs': docs, 'seconds': indexing_seconds, 'docs_per_second': docs / max(indexing_seconds, 1e-9) },
+           'search': search,
+           'rolling_restart': { 'restart_seconds': restart_seconds, 'queries': queries, 'failed_queries': failed,
+                                'availability_pct': 100.0 * (queries - failed) / queries if queries else 100.0 } }
+
+# Smoke tests a single release zip. Unless given the node
+# picks the first free http and transport ports, which is
+# racy if several nodes start concurrently. If dist_dir
+# points to an already extracted distribution the node
+# runs on a hard-linked copy of it instead of a fresh
+# extraction. If `benchmark` is set the node's startup
+# times, memory and latencies over a burst of that many
+# requests per endpoint are measured and returned.
+# All scenarios share one node, which is only started once;
+# after a scenario that writes data its data path is restored
+# from a snapshot taken before the first start.
+def smoke_test_artifact(release, release_file, release_hash, http_port=None, transport_port=None, dist_dir=None, benchmark=0):
+  if not os.path.isfile(release_file):
+    raise RuntimeError('Smoketest failed missing file %s' % (release_file))
+  # (name, scenario, whether it writes data)
+  scenarios = [('checks', checks_scenario, False)]
+  if benchmark:
+    scenarios.append(('benchmark', benchmark_scenario(benchmark), False))
+  tmp_dir = None
+  if not dist_dir:
+    tmp_dir = tempfile.mkdtemp()
+    extract_zip(release_file, tmp_dir)
+    dist_dir = os.path.join(tmp_dir, 'elasticsearch-%s' % (release))
+  print('  Smoke testing package [%s]' % release_file)
+  results = {}
+  try:
+    with SmokeNode(release, release_hash, dist_dir, http_port=http_port, transport_port=transport_port) as node:
+      if any(writes for _, _, writes in scenarios[:-1]):
+        node.snapshot()
+      startup_seconds, green_seconds = node.start()
+      for i, (name, scenario, _) in enumerate(scenarios):
+        if i > 0 and scenarios[i - 1][2]:
+          node.reset()
+        print('     Running scenario [%s]' % name)
+        pool = ConnectionPool(node.host, headers=HEADERS)
+        try:
+          with span('scenario %s' % name, 'scenario'):
+            results[name] = scenario(node, pool, release)
+        finally:
+          pool.close()
+  finally:
+    if tmp_dir:
       shutil.rmtree(tmp_dir)
-    print('  ' + '*' * 80)
-    print()
+  print('  ' + '*' * 80)
+  print()
+  if not benchmark:
+    return None
+  return dict({ 'version': release, 'artifact': os.path.basename(release_file),
+                'startup_seconds': startup_seconds, 'green_seconds': green_seconds }, **results['benchmark'])
+
+# Smoke tests the given (version, hash, url) artifacts with
+# at most `parallel` nodes running at the same time, while
+# the next artifacts are downloaded and extracted. Each
+# artifact gets its own temp dir, pidfile and ports. Returns
+# a list of (version, url, passed, seconds, error) tuples in
+# the order of the given artifacts, the seconds being those
+# spent in the artifact's tasks. download_args are passed
+# on to run_smoke_tests.
+def smoke_test_matrix(artifacts, parallel=1, base_port=9400, trace_path=None, **download_args):
+  runner = TaskRunner(workers=max(1, parallel) + 2, limits={ 'node': max(1, parallel) })
+  try:
+    smoke_tests = run_smoke_tests(runner, [(version, release_hash, url, base_port + i, base_port + 100 + i)
+                                           for i, (version, release_hash, url) in enumerate(artifacts)],
+                                  fail_fast=False, **download_args)
+  finally:
+    if trace_path:
+      write_trace(trace_path)
+  for error in runner.errors.values():
+    traceback.print_exception(type(error), error, error.__traceback__)
+  results = []
+  for (version, _, url), smoke_test in zip(artifacts, smoke_tests):
+    label = smoke_test.name[len('smoke test '):]
+    names = [name for name in runner.tasks if name.endswith(' ' + label)]
+    errors = [str(runner.errors[name]).strip() for name in names if name in runner.errors]
+    took = sum(timing.took for timing in runner.timings if timing.name in names)
+    results.append((version, url, smoke_test.name in runner.results, took, errors[0] if errors else None))
+  return results
+
+def print_results_table(results):
+  print('  ' + '*' * 80)
+  print('  %-6s %10s  %-20s %s' % ('RESULT', 'SECONDS', 'VERSION', 'ARTIFACT'))
+  for version, url, passed, took, error in results:
+    status = '%s%-6s%s' % ((COLOR_OK, 'PASS', COLOR_END) if passed else (COLOR_FAIL, 'FAIL', COLOR_END))
+    print('  %s %10.1f  %-20s %s' % (status, took, version, url))
+    if error:
+      print('  %6s %10s  %s' % ('', '', error.splitlines()[0]))
+  print('  ' + '*' * 80)
 
 # console colors
 COLOR_OK = '\033[92m'
+COLOR_FAIL = '\033[91m'
 COLOR_END = '\033[0m'
 
 def run(command, env_vars=None):
@@ -173,28 +1016,106 @@ def run(command, env_vars=None):
     for key, value in env_vars.items():
       os.putenv(key, value)
   print('*** Running: %s%s%s' % (COLOR_OK, command, COLOR_END))
-  if os.system(command):
-    raise RuntimeError('    FAILED: %s' % (command))
+  with span(command, 'subprocess'):
+    if os.system(command):
+      raise RuntimeError('    FAILED: %s' % (command))
 
 if __name__ == "__main__":
   parser = argparse.ArgumentParser(description='SmokeTests a Release Candidate from S3 staging repo')
-  parser.add_argument('--version', '-v', dest='version', default=None,
-                      help='The Elasticsearch Version to smoke-tests', required=True)
-  parser.add_argument('--hash', '-r', dest='hash', default=None, required=True,
-                      help='The sha1 short hash of the release git commit to smoketest')
-  parser.add_argument('--fetch_url', '-u', dest='url', default=None,
-                      help='Fetched from the specified URL')
-  parser.set_defaults(hash=None)
-  parser.set_defaults(version=None)
+  parser.add_argument('--version', '-v', dest='version', action='append', required=True,
+                      help='The Elasticsearch Version to smoke-tests; can be repeated together with --hash')
+  parser.add_argument('--hash', '-r', dest='hash', action='append', required=True,
+                      help='The sha1 short hash of the release git commit to smoketest; one per --version')
+  parser.add_argument('--fetch_url', '-u', dest='url', action='append',
+                      help='Fetched from the specified URL; one per --version, or several for a single version')
+  parser.add_argument('--parallel', '-p', dest='parallel', type=int, default=1,
+                      help='Number of artifacts to smoke-test concurrently')
+  parser.add_argument('--base_port', dest='base_port', type=int, default=9400,
+                      help='First http port handed out to concurrent nodes; transport ports start 100 above')
+  parser.add_argument('--cache_dir', dest='cache_dir', default=DEFAULT_CACHE_DIR,
+                      help='Directory caching downloaded artifacts; pass an empty value to disable the cache')
+  parser.add_argument('--cache_size', dest='cache_size', type=int, default=DEFAULT_CACHE_SIZE_MB,
+                      help='Size in MB above which the least recently used cached artifacts are evicted')
+  parser.add_argument('--sha512', dest='sha512', default=None,
+                      help='Expected SHA-512 of a single artifact; defaults to the .sha512 file published next to it')
+  parser.add_argument('--benchmark', dest='benchmark', type=int, default=0, metavar='REQUESTS',
+                      help='Measure startup, time to green, memory and the latency of REQUESTS requests per endpoint; single artifact only')
+  parser.add_argument('--benchmark_output', dest='benchmark_output', default=None,
+                      help='File to write the benchmark or cluster results to as JSON; printed if not set')
+  parser.add_argument('--baseline', dest='baseline', default=None,
+                      help='Benchmark results of a previous RC to compare with')
+  parser.add_argument('--regression_threshold', dest='regression_threshold', type=float, default=20,
+                      help='Percentage by which a benchmark metric may exceed the baseline')
+  parser.add_argument('--trace', dest='trace', default=None,
+                      help='File to write the timings of the tasks and the commands, HTTP requests and node starts and stops within them to, as a Chrome trace')
+  parser.add_argument('--nodes', dest='nodes', type=int, default=1,
+                      help='Smoke test on a cluster of this many nodes, measuring indexing, search and a rolling restart; single artifact only, at least 3 nodes before 7.0')
+  parser.add_argument('--docs', dest='docs', type=int, default=10000,
+                      help='Number of synthetic documents indexed into the cluster')
+  parser.add_argument('--bulk_size', dest='bulk_size', type=int, default=1000,
+                      help='Number of documents per bulk request')
+  parser.add_argument('--searches', dest='searches', type=int, default=100,
+                      help='Number of searches per query whose latency is measured on the cluster')
+  parser.add_argument('--min_availability', dest='min_availability', type=float, default=100,
+                      help='Percentage of queries that must succeed during the rolling restart')
   parser.set_defaults(url=None)
   args = parser.parse_args()
-  version = args.version
-  hash = args.hash
-  url = args.url
+  download_args = { 'cache_dir': args.cache_dir, 'cache_size_mb': args.cache_size, 'sha512': args.sha512,
+                    'trace_path': args.trace }
+  if len(args.version) != len(args.hash):
+    parser.error('--version and --hash must be given the same number of times')
   verify_java_version('1.8')
-  if url:
-    download_url = url
+  releases = list(zip(args.version, args.hash))
+  if args.url and len(releases) == 1:
+    artifacts = [(releases[0][0], releases[0][1], url) for url in args.url]
+  elif args.url:
+    if len(args.url) != len(releases):
+      parser.error('--fetch_url must be given once per --version')
+    artifacts = [(version, hash, url) for (version, hash), url in zip(releases, args.url)]
+  else:
+    artifacts = [(version, hash, 'https://staging.elastic.co/%s-%s/downloads/elasticsearch/elasticsearch-%s.zip' % (version, hash, version))
+                 for version, hash in releases]
+  if args.sha512 and len(artifacts) > 1:
+    parser.error('--sha512 is the checksum of a single artifact, the published ones are used for several')
+  if args.benchmark and (len(artifacts) > 1 or args.parallel > 1):
+    parser.error('--benchmark measures a single artifact, concurrent nodes would skew the results')
+  if args.nodes > 1 and (len(artifacts) > 1 or args.parallel > 1 or args.benchmark):
+    parser.error('--nodes measures a single artifact and replaces --benchmark')
+  if args.nodes == 2 and int(artifacts[0][0].split('.')[0]) < 7:
+    parser.error('--nodes 2 needs both nodes to elect a master before 7.0, the cluster would be down during the rolling restart')
+  if args.nodes > 1:
+    version, hash, download_url = artifacts[0]
+    cluster_args = { 'nodes': args.nodes, 'docs': args.docs, 'bulk_size': args.bulk_size, 'requests': args.searches,
+                     'base_port': args.base_port }
+    result = download_release(version, hash, download_url, cluster_args=cluster_args, **download_args)[0]
+    if args.benchmark_output:
+      with open(args.benchmark_output, 'w', encoding='utf-8') as output:
+        json.dump(result, output, indent=2)
+    else:
+      print(json.dumps(result, indent=2))
+    availability = result['rolling_restart']['availability_pct']
+    if availability < args.min_availability:
+      raise RuntimeError('only %.1f%% of the queries succeeded during the rolling restart' % availability)
+  elif len(artifacts) == 1 and args.parallel <= 1:
+    version, hash, download_url = artifacts[0]
+    results = download_release(version, hash, download_url, benchmark=args.benchmark, **download_args)
+    if args.benchmark:
+      result = results[0]
+      if args.benchmark_output:
+        with open(args.benchmark_output, 'w', encoding='utf-8') as output:
+          json.dump(result, output, indent=2)
+      else:
+        print(json.dumps(result, indent=2))
+      if args.baseline:
+        with open(args.baseline, encoding='utf-8') as baseline:
+          regressions = benchmark_regressions(result, json.load(baseline), args.regression_threshold)
+        for metric, previous, current in regressions:
+          print('  %sREGRESSION%s %s: %.2f -> %.2f' % (COLOR_FAIL, COLOR_END, metric, previous, current))
+        if regressions:
+          raise RuntimeError('%d benchmark metrics regressed by more than %s%%' % (len(regressions), args.regression_threshold))
   else:
-    download_url = 'https://staging.elastic.co/%s-%s/downloads/elasticsearch/elasticsearch-%s.zip' % (version, hash, version)
-  download_release(version, hash, download_url)
+    results = smoke_test_matrix(artifacts, args.parallel, args.base_port, **download_args)
+    print_results_table(results)
+    if not all(passed for _, _, passed, _, _ in results):
+      raise RuntimeError('Smoketest failed for %d of %d artifacts' % (sum(1 for r in results if not r[2]), len(results)))
 
@@ -0,0 +1,115 @@
+#!/usr/bin/python3
+#
+# Copyright Elasticsearch B.V. and/or licensed to Elasticsearch B.V. under one
+# or more contributor license agreements. Licensed under the Elastic License
+# 2.0; you may not use this file except in compliance with the Elastic License
+# 2.0.
+#
+
+# Stand-in for TDVT's tdvt_launcher.py, used by `tdvt_run.py --local`: it replays a recording of the launcher's output
+# and prompts, with the recorded delays, and produces the files the runner relies on (the workspace's config files and
+# the results CSV). This allows exercising the runner without Windows, Tableau or a TDVT SDK checkout.
+
+import csv
+import json
+import os
+import sys
+import time
+
+RECORDING_FILE = "recording.json"
+RESULTS_CSV = "test_results_combined.csv"
+RESULTS_HEADER = ["Suite", "Test Set", "TDSName", "TestName", "Test Case", "Passed", "Query Time (ms)"]
+
+# Each command maps to a sequence of events: "out" prints a text, "prompt" prints a text and waits for an answer;
+# "delay" is the number of seconds to wait before the event. The results' type is the TDVT category they belong to.
+DEFAULT_RECORDING = {
+    "speed": 1.0,
+    "action --setup": [
+        {"out": "Creating TDVT workspace.\n", "delay": 0.5},
+        {"out": "Workspace setup complete.\n", "delay": 0.2},
+    ],
+    "action --add_ds": [
+        {"out": "Adding data source elastic.\n", "delay": 0.5},
+        {"prompt": "Would you like to setup a password file? (y/n)\nEnter 'y' to create one connection per tds "
+            "(standard).", "delay": 0.3},
+        {"prompt": "Enter the logical query config, or press enter to skip selecting one now:", "delay": 0.3},
+        {"prompt": "Overwrite existing ini file?(y/n)", "delay": 0.2},
+        {"out": "Created config/elastic.ini\n", "delay": 0.2},
+    ],
+    "run": [
+        {"out": "Starting TDVT run of elastic.\n", "delay": 1.0},
+        {"out": "Running tests...\n", "delay": 2.0},
+        {"out": "Test run complete.\n", "delay": 0.5},
+    ],
+    "results": [
+        {"type": "expression", "test": "expression.standard.calcs.agg.avg", "case": "AVG([int0])", "passed": True,
+            "query_ms": 35},
+        {"type": "expression", "test": "expression.standard.calcs.string.lower", "case": "LOWER([str0])",
+            "passed": True, "query_ms": 21},
+        {"type": "logical", "test": "logical.calcs.filter.int", "case": "setup.calcs.int0", "passed": True,
+            "query_ms": 48},
+        {"type": "logical", "test": "logical.staples.lod", "case": "setup.staples.lod", "passed": False,
+            "query_ms": 112},
+    ],
+}
+
+def load_recording():
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), RECORDING_FILE)
+    if not os.path.isfile(path):
+        return DEFAULT_RECORDING
+    with open(path) as src:
+        return dict(DEFAULT_RECORDING, **json.load(src))
+
+def replay(events, speed):
+    answers = []
+    for event in events:
+        time.sleep(event.get("delay", 0) / speed)
+        if "prompt" in event:
+            print(event["prompt"], end="", flush=True)
+            answers.append(input())
+            print()
+        else:
+            print(event["out"], end="", flush=True)
+    return answers
+
+def setup():
+    os.makedirs(os.path.join("config", "tdvt"), exist_ok=True)
+    os.makedirs("tds", exist_ok=True)
+    with open(os.path.join("config", "tdvt", "tdvt_override.ini"), "w") as ini:
+        ini.write("[DEFAULT]\nTAB_CLI_EXE_X64 = \n")
+
+def add_data_source(name, answers):
+    with open(os.path.join("config", name + ".ini"), "w") as ini:
+        ini.write("[Datasource]\nName = %s\nLogicalQueryFormat = %s\n" % (name, answers[1] if len(answers) > 1 else ""))
+
+def write_results(name, results, categories):
+    with open(RESULTS_CSV, "w", newline="") as dest:
+        writer = csv.writer(dest)
+        writer.writerow(RESULTS_HEADER)
+        for result in results:
+            if categories and result["type"] not in categories:
+                continue
+            writer.writerow([name, result["type"], "cast_calcs.%s.tds" % name, result["test"], result["case"],
+                str(result["passed"]), result["query_ms"]])
+
+def main(argv):
+    recording = load_recording()
+    speed = recording.get("speed") or 1.0
+    if argv[:2] == ["action", "--setup"]:
+        replay(recording["action --setup"], speed)
+        setup()
+    elif argv[:2] == ["action", "--add_ds"] and len(argv) > 2:
+        add_data_source(argv[2], replay(recording["action --add_ds"], speed))
+    elif argv[:1] == ["run"] and len(argv) > 1:
+        categories = [arg[2:] for arg in argv[2:] if arg in ("--expression", "--logical")]
+        replay(recording["run"], speed * (len(categories) or 1)) # a category is only part of the suite
+        write_results(argv[1], recording["results"], categories)
+    else:
+        print("Unsupported arguments: %s" % argv, file=sys.stderr)
+        return 2
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
+
+# vim: set noet fenc=utf-8 ff=dos sts=0 sw=4 ts=4 tw=118 expandtab :